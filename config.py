@@ -2,6 +2,8 @@
 
 PDF_PATH = "Physics-11 1-92-126.pdf"
 OUTPUT_JSON = "physics_structure.json"
+# Chapter the bundled PDF covers; build_hierarchy uses it unless told otherwise
+CHAPTER_TITLE = "SYSTEMS OF PARTICLES AND ROTATIONAL MOTION"
 
 IMAGE_DIR = "./extract_images"
 
@@ -16,17 +16,18 @@ from qdrant_client.models import (
     Distance, 
     PointStruct,
     SparseVectorParams,
-    SparseIndexParams,
-    SparseVector
+    SparseIndexParams
 )
 from qdrant_client.http.models import Filter, FieldCondition, MatchValue
 import torch
+from sparse_vectors import build_sparse_vector
 
 # Load environment variables
 load_dotenv()
 
 # Configuration
 QDRANT_PATH = "./qdrant_data" # Local persistent storage
+QDRANT_URL = os.getenv("QDRANT_URL") # Optional Qdrant server; uses gRPC when set
 EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL", "nomic-ai/nomic-embed-text-v1.5")
 COLLECTION_NAME = "physics_textbook"
 
@@ -34,25 +35,46 @@ COLLECTION_NAME = "physics_textbook"
 device = "cuda" if torch.cuda.is_available() else "cpu"
 print(f"Using device: {device}")
 
-def split_structural_blocks(text: str) -> List[str]:
+# Keep in sync with retriever.py: FP16 weights on GPU, FP32 on CPU
+EMBEDDING_MODEL_KWARGS = {'device': device, 'trust_remote_code': True}
+if device == "cuda":
+    EMBEDDING_MODEL_KWARGS['model_kwargs'] = {'torch_dtype': torch.float16}
+
+def create_qdrant_client() -> QdrantClient:
     """
-    Split text into structural blocks based on textbook patterns.
+    Creates the Qdrant client: a gRPC connection with keep-alive when
+    QDRANT_URL is set, otherwise the embedded local storage.
     """
-    # Patterns for structural boundaries
-    patterns = [
-        r"(?=^Example\s+\d+(?:\.\d+)?)", # Non-capturing group
-        r"(?=^Summary)",
-        r"(?=^Points to Ponder)",
-        r"(?=^Exercises)",
-        r"(?=^\d+\.\d+\s+[A-Z])",  # subsection like 6.1.1 Title
-    ]
-
-    combined_pattern = "|".join(patterns)
-
-    blocks = re.split(combined_pattern, text, flags=re.MULTILINE)
+    if QDRANT_URL:
+        return QdrantClient(
+            url=QDRANT_URL,
+            prefer_grpc=True,
+            timeout=60,
+            grpc_options={"grpc.keepalive_time_ms": 30000}
+        )
+    return QdrantClient(path=QDRANT_PATH)
+
+# Structural patterns, compiled once at import (applied to every section/subsection)
+EXAMPLE_BULLET_RE = re.compile(r"(?:^|\n)\s*[uU]\s+Example")
+EXAMPLE_NUMBER_RE = re.compile(r"Example\s+(\d+(\.\d+)?)")
+ANSWER_BULLET_RE = re.compile(r"(?:^|\n)\s*[uU]\s+Answer")
+STANDALONE_BULLET_RE = re.compile(r"(?:^|\n)\s*[uU]\s*(\n|$)")
+EXAMPLE_START_RE = re.compile(r"\s+(Example\s+\d+(\.\d+)?)")
+EXTRA_NEWLINES_RE = re.compile(r"\n{3,}")
+
+STRUCTURAL_SPLIT_RE = re.compile(
+    "|".join([
+        r"(?=^\s*Example\s+\d+(?:\.\d+)?)",
+        r"(?=^\s*Summary)",
+        r"(?=^\s*Points to Ponder)",
+        r"(?=^\s*Exercises)",
+        r"(?=^\s*\d+\.\d+\s+[A-Z])",  # subsection like 6.1.1 Title
+    ]),
+    re.MULTILINE
+)
 
-    # Clean empty blocks
-    return [b.strip() for b in blocks if b and b.strip()]
+# Image tags: [IMAGE: ./extract_images\fig_6_2.png]
+IMAGE_TAG_RE = re.compile(r"\[IMAGE: (.*?)\]")
 
 def clean_text_noise(text: str) -> str:
     """
@@ -72,14 +94,15 @@ def clean_text_noise(text: str) -> str:
             
         # Rule 1: Page headers/footers (mostly uppercase and short)
         # Heuristic: > 50% uppercase letters and length < 60
-        upper_count = sum(1 for c in stripped if c.isupper())
+        # Length is checked first so long lines never pay for the count;
+        # map/sum counts in C, and the ratio test avoids a float divide
         total_len = len(stripped)
         
-        if total_len > 0:
-            upper_ratio = upper_count / total_len
+        if total_len < 60:
+            upper_count = sum(map(str.isupper, stripped))
             
             # Strong signal: Short and mostly uppercase
-            if total_len < 60 and upper_ratio > 0.5:
+            if upper_count * 2 > total_len:
                 # Check for specific noise keywords
                 if any(x in stripped for x in ["CHAPTER", "Summary", "Points to Ponder", "Exercises", "PHYSICS", "SYSTEMS OF"]):
                     continue
@@ -107,20 +130,20 @@ def normalize_text_for_structure(text: str) -> str:
     Normalize text before structural splitting.
     """
     # 1. Remove bullet markers before Example (e.g. "u Example")
-    text = re.sub(r"(?:^|\n)\s*[uU]\s+Example", "\nExample", text)
+    text = EXAMPLE_BULLET_RE.sub("\nExample", text)
     
     # 2. Flatten "Example \n 6.1" to "Example 6.1"
-    text = re.sub(r"Example\s+(\d+(\.\d+)?)", r"Example \1", text)
+    text = EXAMPLE_NUMBER_RE.sub(r"Example \1", text)
 
     # 3. Remove bullet markers before Answer (e.g. "u Answer") or standalone "u"
-    text = re.sub(r"(?:^|\n)\s*[uU]\s+Answer", "\nAnswer", text)
-    text = re.sub(r"(?:^|\n)\s*[uU]\s*(\n|$)", r"\n", text)
+    text = ANSWER_BULLET_RE.sub("\nAnswer", text)
+    text = STANDALONE_BULLET_RE.sub(r"\n", text)
 
     # 4. Ensure Example always starts on a new line (helps regex detection)
-    text = re.sub(r"\s+(Example\s+\d+(\.\d+)?)", r"\n\n\1", text)
+    text = EXAMPLE_START_RE.sub(r"\n\n\1", text)
     
     # Deduplicate newlines
-    text = re.sub(r"\n{3,}", "\n\n", text)
+    text = EXTRA_NEWLINES_RE.sub("\n\n", text)
     
     return text
 
@@ -131,19 +154,8 @@ def split_structural_blocks(text: str) -> List[str]:
     # Step 1: Normalize
     text = normalize_text_for_structure(text)
     
-    # Step 2: Flexible Regex Patterns with Anchors
-    patterns = [
-        r"(?=^\s*Example\s+\d+(?:\.\d+)?)",
-        r"(?=^\s*Summary)",
-        r"(?=^\s*Points to Ponder)",
-        r"(?=^\s*Exercises)",
-        r"(?=^\s*\d+\.\d+\s+[A-Z])",  # subsection like 6.1.1 Title
-    ]
-
-    combined_pattern = "|".join(patterns)
-
-    # Use re.split
-    blocks = re.split(combined_pattern, text, flags=re.MULTILINE)
+    # Step 2: Split on the anchored structural patterns
+    blocks = STRUCTURAL_SPLIT_RE.split(text)
 
     # Clean empty blocks
     cleaned_blocks = [b.strip() for b in blocks if b and b.strip()]
@@ -156,26 +168,20 @@ def merge_example_answer_blocks(blocks: List[str]) -> List[str]:
     Merges 'Example X.Y' blocks with their subsequent 'Answer' blocks.
     """
     merged = []
-    i = 0
-    while i < len(blocks):
-        block = blocks[i]
-        block_stripped = block.strip()
+    skip_next = False
+    last = len(blocks) - 1
+    for i, block in enumerate(blocks):
+        if skip_next: # Already folded into the previous Example
+            skip_next = False
+            continue
         
-        # Check if this block is an Example
-        if block_stripped.startswith("Example"):
-            combined = block
-            
-            # Look ahead for Answer
-            if i + 1 < len(blocks):
-                next_block = blocks[i+1]
-                if next_block.strip().startswith("Answer"):
-                    combined += "\n\n" + next_block
-                    i += 1 # Skip next block
-            
-            merged.append(combined)
+        # Example followed by its Answer: merge the pair (lstrip is enough for a prefix test)
+        if (block.lstrip().startswith("Example") and i < last
+                and blocks[i + 1].lstrip().startswith("Answer")):
+            merged.append(block + "\n\n" + blocks[i + 1])
+            skip_next = True
         else:
             merged.append(block)
-        i += 1
     
     return merged
 
@@ -356,7 +362,8 @@ def ingest_data(file_input: Any, progress_callback=None, status_callback=None, c
     log(f"Initializing embedding model: {EMBEDDING_MODEL_NAME} on {device}...")
     embeddings = HuggingFaceEmbeddings(
         model_name=EMBEDDING_MODEL_NAME,
-        model_kwargs={'device': device, 'trust_remote_code': True}
+        model_kwargs=EMBEDDING_MODEL_KWARGS,
+        encode_kwargs={'normalize_embeddings': True}
     )
     
     # Removed SemanticChunker - using content-driven aggregation
@@ -375,9 +382,6 @@ def ingest_data(file_input: Any, progress_callback=None, status_callback=None, c
     log("Chunking data...")
     documents = []
 
-    # Regex for image tags: [IMAGE: ./extract_images\fig_6_2.png]
-    image_pattern = re.compile(r"\[IMAGE: (.*?)\]")
-    
     # Update progress for chunking (allocating 20% of progress)
     total_raw = len(raw_items)
     
@@ -397,7 +401,7 @@ def ingest_data(file_input: Any, progress_callback=None, status_callback=None, c
             # NEW: Track both references and full paths
             image_refs = []
             image_paths = [] 
-            matches = image_pattern.findall(chunk_text)
+            matches = IMAGE_TAG_RE.findall(chunk_text)
             
             for match in matches:
                 # Normalize path separators
@@ -430,49 +434,6 @@ def ingest_data(file_input: Any, progress_callback=None, status_callback=None, c
             
     log(f"Generated {len(documents)} semantic chunks.")
 
-    # ------------------------------
-    # Build BM25 Sparse Vectors
-    # ------------------------------
-    log("Building BM25 sparse vectors...")
-    
-    # Tokenize all documents
-    corpus = [doc.page_content.lower().split() for doc in documents]
-    
-    # Build vocabulary mapping
-    vocab = {}
-    vocab_index = 0
-    
-    for tokens in corpus:
-        for token in set(tokens):
-            if token not in vocab:
-                vocab[token] = vocab_index
-                vocab_index += 1
-    
-    log(f"Built vocabulary with {len(vocab)} unique tokens")
-    
-    # Function to build sparse vector for a document
-    def build_sparse_vector(text: str) -> SparseVector:
-        tokens = text.lower().split()
-        token_counts = {}
-        
-        # Count token frequencies
-        for token in tokens:
-            if token in vocab:
-                token_counts[token] = token_counts.get(token, 0) + 1
-        
-        # Build sparse vector
-        indices = []
-        values = []
-        
-        for token, count in token_counts.items():
-            indices.append(vocab[token])
-            values.append(float(count))
-        
-        return SparseVector(
-            indices=indices,
-            values=values
-        )
-
     if not documents:
         log("[WARNING] No chunks generated. Aborting ingestion to preserve existing data.")
         return
@@ -480,10 +441,10 @@ def ingest_data(file_input: Any, progress_callback=None, status_callback=None, c
     
     # Initialize Qdrant
     if client is None:
-        log(f"[DEBUG] No client provided to ingest_data. Initializing new QdrantClient at {QDRANT_PATH}...")
+        log(f"[DEBUG] No client provided to ingest_data. Initializing new QdrantClient at {QDRANT_URL or QDRANT_PATH}...")
         try:
-            client = QdrantClient(path=QDRANT_PATH)
-            log(f"[DEBUG] Local QdrantClient initialized.")
+            client = create_qdrant_client()
+            log(f"[DEBUG] QdrantClient initialized.")
         except Exception as e:
             log(f"[ERROR] Failed to initialize local QdrantClient in ingest_data: {e}")
             return
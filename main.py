@@ -6,10 +6,8 @@ from groq import Groq
 import re
 import base64
 
-from qdrant_client import QdrantClient
-
 from retriever import PhysicsRetriever
-from ingest import ingest_data
+from ingest import ingest_data, create_qdrant_client, QDRANT_URL, QDRANT_PATH
 from ui.styles import load_custom_css
 
 # Load env declaration
@@ -36,12 +34,14 @@ if "selected_chapters" not in st.session_state:
 if "available_chapters" not in st.session_state:
     st.session_state.available_chapters = None
 
+# Ingestion returns the CUDA cache only when this many bytes sit reserved but unused
+GPU_CACHE_RELEASE_BYTES = 1024 ** 3
+
 @st.cache_resource(show_spinner=False)
 def get_qdrant_client():
     try:
-        path = "./qdrant_data"
-        print(f"[DEBUG] Initializing QdrantClient with path: {os.path.abspath(path)}")
-        client = QdrantClient(path=path)
+        print(f"[DEBUG] Initializing QdrantClient at: {QDRANT_URL or os.path.abspath(QDRANT_PATH)}")
+        client = create_qdrant_client()
         print(f"[DEBUG] QdrantClient initialized successfully. Collections: {client.get_collections()}")
         return client
     except Exception as e:
@@ -65,6 +65,15 @@ if "retriever" not in st.session_state:
             print(f"[ERROR] Retriever initialization failed: {e}")
             st.error(f"Failed to initialize retriever: {e}")
 
+@st.cache_data(ttl=5, show_spinner=False)
+def get_cached_collection_stats(retriever_id: int):
+    # retriever_id is part of the cache key, so a replaced retriever is re-queried
+    return st.session_state.retriever.refresh_collection_stats()
+
+@st.cache_data(ttl=10, show_spinner=False)
+def get_cached_connection_status(retriever_id: int):
+    return st.session_state.retriever.check_connection()
+
 @st.cache_resource(show_spinner=False)
 def get_groq_client():
     api_key = os.getenv("GROQ_API_KEY")
@@ -141,6 +150,17 @@ Always begin your response with:
 
 """
 
+DISPLAY_MATH_RE = re.compile(r"\\\[(.*?)\\\]", re.DOTALL)
+BRACKET_MATH_RE = re.compile(r"\[\s*(.*?)\s*\]", re.DOTALL)
+INLINE_EQUATION_LINE_RE = re.compile(r"\n\$(.*?)=(.*?)\$\n")
+
+def _replace_brackets(match):
+    # Only bracketed text that looks like LaTeX becomes display math
+    content = match.group(1)
+    if "\\" in content or "^" in content or "_" in content:
+        return f"\n\n$$\n{content}\n$$\n\n"
+    return match.group(0)
+
 def normalize_latex(text):
     """
     Makes LaTeX rendering robust:
@@ -152,22 +172,12 @@ def normalize_latex(text):
     # Fix double-escaped backslashes
     text = text.replace("\\\\", "\\")
 
-    text = re.sub(r"\\\[(.*?)\\\]", r"\n\n$$\1$$\n\n", text, flags=re.DOTALL)
+    text = DISPLAY_MATH_RE.sub(r"\n\n$$\1$$\n\n", text)
 
     # Convert bracketed LaTeX blocks to display math
-    def replace_brackets(match):
-        content = match.group(1)
-        if "\\" in content or "^" in content or "_" in content:
-            return f"\n\n$$\n{content}\n$$\n\n"
-        return match.group(0)
-
-    text = re.sub(r"\[\s*(.*?)\s*\]", replace_brackets, text, flags=re.DOTALL)
-
-    text = re.sub(
-        r"\n\$(.*?)=(.*?)\$\n",
-        r"\n\n$$\1=\2$$\n\n",
-        text
-    )
+    text = BRACKET_MATH_RE.sub(_replace_brackets, text)
+
+    text = INLINE_EQUATION_LINE_RE.sub(r"\n\n$$\1=\2$$\n\n", text)
 
     return text
 
@@ -199,6 +209,9 @@ def get_relevant_images(image_refs, image_folder="extract_images"):
     return sorted(list(set(found_images)))
 
 def inject_images_in_text(response_text, image_paths):
+    if not image_paths or "Fig." not in response_text:
+        return response_text
+
     for path in image_paths:
         filename = os.path.basename(path)
         figure_number = filename.replace("fig_", "").replace(".png", "").replace("_", ".")
@@ -210,8 +223,15 @@ def inject_images_in_text(response_text, image_paths):
 
     return response_text
 
+IMAGE_SPLIT_RE = re.compile(r"\[\[IMAGE::(.*?)\]\]")
+
 def render_response(text):
-    parts = re.split(r"\[\[IMAGE::(.*?)\]\]", text)
+    # Most answers cite no figure: skip the split entirely
+    if "[[IMAGE::" not in text:
+        st.markdown(text)
+        return
+
+    parts = IMAGE_SPLIT_RE.split(text)
 
     for i, part in enumerate(parts):
         if i % 2 == 0:
@@ -226,26 +246,27 @@ def render_response(text):
                     fig_name = os.path.basename(part).replace("fig_", "Fig. ").replace(".png", "").replace("_", ".")
                     st.caption(fig_name)
 
+VISUAL_CONTEXT_NOTE = "\n[Visual Context: Relevant images/diagrams are available to the user for this section.]"
+CONTEXT_TEMPLATE = "\n--- Context {i} ---\n**Location**: {loc} - {title}\n**Content**:\n{body}{img}\n"
+
 def format_contexts(chunks):
-    formatted = []
+    parts = []
+    append = parts.append
+    tmpl = CONTEXT_TEMPLATE.format
     for i, chunk in enumerate(chunks, 1):
-        meta = chunk.payload['metadata']
-        location = f"Section {meta['section_number']}"
-        if meta.get('subsection_number'):
-            location += f".{meta['subsection_number']}"
-            
+        payload = chunk.payload
+        meta = payload['metadata']
+        section_number = meta['section_number']
+        subsection_number = meta.get('subsection_number')
+
+        loc = f"Section {section_number}.{subsection_number}" if subsection_number else f"Section {section_number}"
+        title = meta.get('subsection_title') or meta['section_title']
+
         # Check for images
-        image_note = ""
-        if meta.get('image_refs'):
-            image_note = "\n[Visual Context: Relevant images/diagrams are available to the user for this section.]"
-        
-        formatted.append(f"""
---- Context {i} ---
-**Location**: {location} - {meta.get('subsection_title') or meta['section_title']}
-**Content**:
-{chunk.payload['text']}{image_note}
-""")
-    return "\n".join(formatted)
+        image_note = VISUAL_CONTEXT_NOTE if meta.get('image_refs') else ""
+
+        append(tmpl(i=i, loc=loc, title=title, body=payload['text'], img=image_note))
+    return "\n".join(parts)
 
 # UI Layout
 st.title("📚 Physics Textbook AI Tutor")
@@ -259,9 +280,9 @@ with st.sidebar:
     st.subheader("📊 Database Status")
     if "retriever" in st.session_state:
         retriever = st.session_state.retriever
-        if retriever.check_connection():
+        if get_cached_connection_status(id(retriever)):
             st.success("✅ Qdrant Connected")
-            stats = retriever.get_collection_stats()
+            stats = get_cached_collection_stats(id(retriever))
             st.markdown(f"""
             <div class="metric-container">
                 <h3>Total Chunks</h3>
@@ -324,20 +345,30 @@ with st.sidebar:
                 progress_bar.progress(80)
                 status_text.text("Cleaning up resources...")
                 
-                # CRITICAL: Force GPU to release memory after ingestion
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
+                # Drop cycle-held objects first so their tensors are freed
+                # before measuring.
                 gc.collect()
+                # empty_cache can only return reserved-but-unallocated blocks,
+                # and it forces a CUDA sync that stalls the next embedding
+                # call, so skip it unless that slack is large.
+                if torch.cuda.is_available() and (
+                    torch.cuda.memory_reserved() - torch.cuda.memory_allocated() > GPU_CACHE_RELEASE_BYTES
+                ):
+                    torch.cuda.empty_cache()
 
                 # Clean up temp PDF
                 if os.path.exists(temp_pdf_path):
                     os.remove(temp_pdf_path)
                     
-                status_text.text("Ingestion Complete. Reloading Retriever...")
+                status_text.text("Ingestion Complete. Refreshing collection stats...")
                 progress_bar.progress(100)
                 
-                # 4. Refresh retriever and chapter cache
-                st.session_state.retriever = get_retriever()
+                # 4. Refresh collection stats (models stay loaded) and chapter cache
+                if "retriever" in st.session_state:
+                    st.session_state.retriever.refresh_collection_stats()
+                else:
+                    st.session_state.retriever = get_retriever()
+                get_cached_collection_stats.clear()
                 # Clear chapter cache to show newly ingested chapter
                 if "available_chapters" in st.session_state:
                     st.session_state.available_chapters = None
@@ -421,7 +452,11 @@ with st.sidebar:
         st.markdown("**🗑️ Delete Chapters**")
         
         if selected_chapters:
-            if st.button("Delete Selected Chapters", type="secondary"):
+            # Form body only has side-effects on explicit submit, not on every rerun
+            with st.form("chapter_admin", clear_on_submit=False):
+                submitted = st.form_submit_button("Delete Selected Chapters", type="secondary")
+
+            if submitted:
                 from qdrant_client.models import Filter, FieldCondition, MatchValue
                 
                 delete_filter = Filter(
@@ -440,6 +475,8 @@ with st.sidebar:
                 )
                 
                 st.success(f"✅ Deleted: {', '.join(selected_chapters)}")
+                st.session_state.available_chapters = None
+                get_cached_collection_stats.clear()
                 st.rerun()
         else:
             st.warning("⚠️ No chapters selected - searches will return no results")
@@ -450,8 +487,11 @@ with st.sidebar:
 
     # 4. Retrieval Settings
     st.subheader("🔍 Retrieval Settings")
-    top_k = st.slider("Initial Retrieval (K)", 10, 50, 20)
-    final_chunks = st.slider("Final Context Chunks", 3, 15, 6)
+    # Slider changes only take effect once Apply is pressed
+    with st.form("retrieval_settings"):
+        top_k = st.slider("Initial Retrieval (K)", 10, 50, 20)
+        final_chunks = st.slider("Final Context Chunks", 3, 15, 6)
+        st.form_submit_button("Apply")
     
     # 4. Advanced Options
     with st.expander("🛠️ Advanced"):
@@ -465,7 +505,7 @@ chat_container = st.container()
 
 with chat_container:
     # Display chat history
-    for msg in st.session_state.messages:
+    for msg_idx, msg in enumerate(st.session_state.messages):
         with st.chat_message(msg["role"]):
             st.markdown(msg["content"])
             
@@ -485,15 +525,13 @@ with chat_container:
                             </div>
                             """, unsafe_allow_html=True)
                 
-                # Show raw context if available
+                # Show raw context if available (plain text_area avoids syntax highlighting)
                 if msg.get("context"):
                     with st.expander("🔍 Debug: View Context passed to LLM"):
-                        st.code(msg["context"])
-
-                # Show raw context if available
-                if msg.get("context"):
-                    with st.expander("� Debug: View Context passed to LLM"):
-                        st.code(msg["context"])
+                        st.text_area(
+                            "Context", msg["context"], height=200, disabled=True,
+                            label_visibility="collapsed", key=f"context_{msg_idx}"
+                        )
 
                 # Images are now injected into the text, so no need to show them separately here.
 
@@ -516,24 +554,20 @@ if prompt := st.chat_input("Ask a question about the chapter..."):
         # Retrieval phase
         with st.spinner("🔍 Searching textbook..."):
             t0 = time.time()
-            # Initial retrieval with chapter filter
+            # Fused retrieval + reranking with chapter filter
             chapter_filter = st.session_state.get('selected_chapters', None)
-            results = st.session_state.retriever.retrieve(
+            reranked_results = st.session_state.retriever.retrieve_and_rerank(
                 prompt, 
                 top_k=top_k,
+                final_k=final_chunks,
                 chapter_filter=chapter_filter
             )
             t1 = time.time()
             retrieval_time = t1 - t0
             
-            # Reranking
-            reranked_results = st.session_state.retriever.rerank(prompt, results, top_k=final_chunks)
-            t2 = time.time()
-            rerank_time = t2 - t1
-            
             context_str = format_contexts(reranked_results)
-            t3 = time.time()
-            context_time = t3 - t2
+            t2 = time.time()
+            context_time = t2 - t1
         
         # Generation phase
         with st.spinner("✍️ Generating answer..."):
@@ -596,11 +630,10 @@ if prompt := st.chat_input("Ask a question about the chapter..."):
                 
                  # Performance Metrics
                 with st.expander("⏱️ Performance Metrics", expanded=False):
-                    col1, col2, col3, col4 = st.columns(4)
-                    col1.metric("Retrieval (Qdrant)", f"{retrieval_time:.2f}s")
-                    #col2.metric("Reranking", f"{rerank_time:.2f}s")
-                    col3.metric("Context Prep", f"{context_time:.2f}s")
-                    col4.metric("LLM Generation", f"{generation_time:.2f}s")
+                    col1, col2, col3 = st.columns(3)
+                    col1.metric("Retrieval + Rerank", f"{retrieval_time:.2f}s")
+                    col2.metric("Context Prep", f"{context_time:.2f}s")
+                    col3.metric("LLM Generation", f"{generation_time:.2f}s")
                 
                 # Extract and store sources
                 # 1. Extract and store sources including image_paths
@@ -651,7 +684,10 @@ if prompt := st.chat_input("Ask a question about the chapter..."):
                                 """, unsafe_allow_html=True)
                     
                     with st.expander("🔍 Debug: View Context passed to LLM"):
-                        st.code(context_str)
+                        st.text_area(
+                            "Context", context_str, height=200, disabled=True,
+                            label_visibility="collapsed", key=f"context_{len(st.session_state.messages)}"
+                        )
 
                     # Removed "Relevant Diagrams" section (images now inline)
                 
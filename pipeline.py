@@ -2,16 +2,20 @@
 import os
 import shutil
 import uuid
+import config
 from ingest import ingest_data
 from step3_classify_blocks import classify_and_clean
 from step4_to_json import build_hierarchy, save_structure
 
-def run_pdf_pipeline(pdf_path, output_dir="./processed_data", client=None, status_callback=None, progress_callback=None):
+def run_pdf_pipeline(pdf_path, output_dir="./processed_data", client=None, status_callback=None, progress_callback=None, chapter_title=config.CHAPTER_TITLE):
     """
     Runs the full pipeline:
     1. Extract blocks & images (step 3)
     2. Build JSON hierarchy (step 4)
     3. Ingest into Qdrant
+
+    chapter_title names the chapter in the JSON, and ingest derives the
+    chapter_id used for filtering/deletion from it.
     """
     
     # Create unique output directory for this run to avoid collisions
@@ -34,7 +38,7 @@ def run_pdf_pipeline(pdf_path, output_dir="./processed_data", client=None, statu
     
     # Step 3: Build JSON
     print("[Pipeline] Building hierarchy...")
-    hierarchy = build_hierarchy(classified_items)
+    hierarchy = build_hierarchy(classified_items, chapter_title=chapter_title)
     save_structure(hierarchy, json_path)
     
     # Step 4: Ingest
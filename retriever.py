@@ -1,10 +1,18 @@
 import os
+import bisect
+import functools
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any
+import numpy as np
 from dotenv import load_dotenv
 from langchain_huggingface import HuggingFaceEmbeddings
 from qdrant_client import QdrantClient, models
 from qdrant_client.models import SparseVector, Filter, FieldCondition, MatchValue
 from sentence_transformers import CrossEncoder
+from sparse_vectors import build_sparse_vector
 import torch
 
 # Load environment variables
@@ -15,9 +23,25 @@ QDRANT_PATH = "./qdrant_data"
 COLLECTION_NAME = "physics_textbook"
 EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL", "nomic-ai/nomic-embed-text-v1.5")
 RERANKER_MODEL_NAME = os.getenv("RERANKER_MODEL", "BAAI/bge-reranker-v2-m3")
+ENABLE_RERANKER = os.getenv("ENABLE_RERANKER", "false").lower() in ("1", "true", "yes")
+RERANKER_BACKEND = os.getenv("RERANKER_BACKEND", "torch") # "torch", "onnx" or "openvino"
+RERANK_CACHE_PATH = os.getenv("RERANK_CACHE_PATH", "rerank_cache.db")
+QUERY_CACHE_SIZE = 1024
+# Reranker pairs are batched by token length so short passages aren't padded to the longest
+RERANK_LENGTH_BUCKETS = (64, 128, 256, 512)
+# Candidates passed to the cross-encoder after the cheap overlap prune
+RERANK_CANDIDATES = 10
+# Candidates whose dense vectors are more similar than this are treated as duplicates
+DEDUP_SIMILARITY = 0.95
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
+# Half precision on GPU halves memory traffic for the embedding forward pass.
+# CPU stays in FP32, where fp16/bf16 matmuls are usually slower.
+EMBEDDING_MODEL_KWARGS = {'device': device, 'trust_remote_code': True}
+if device == "cuda":
+    EMBEDDING_MODEL_KWARGS['model_kwargs'] = {'torch_dtype': torch.float16}
+
 class PhysicsRetriever:
     def __init__(self, client):
         print(f"[DEBUG] Retriever.__init__ called. Device: {device}")
@@ -31,48 +55,69 @@ class PhysicsRetriever:
         except Exception as e:
             print(f"[ERROR] Failed to verify Qdrant connection in Retriever: {e}")
             raise e
-        
+
+        self.collection_stats = self.get_collection_stats()
+
         # Initialize Embedding Model
         print("Loading Embedding Model...")
         self.embeddings = HuggingFaceEmbeddings(
             model_name=EMBEDDING_MODEL_NAME,
-            model_kwargs={'device': device, 'trust_remote_code': True}
+            model_kwargs=EMBEDDING_MODEL_KWARGS,
+            encode_kwargs={'normalize_embeddings': True}
         )
         
-        # Initialize Reranker
-        # print("Loading Reranker Model...")
-        # self.reranker = CrossEncoder(
-        #     model_name=RERANKER_MODEL_NAME,
-        #     device=device,
-        #     trust_remote_code=True
-        # )
+        # Cache query encodings so repeated queries skip the transformer forward pass
+        self._encode_query = functools.lru_cache(maxsize=QUERY_CACHE_SIZE)(self._embed_query)
+        self._sparse_query = functools.lru_cache(maxsize=QUERY_CACHE_SIZE)(self.build_sparse_query)
+
+        # Sparse query is built on a worker thread while the dense forward pass runs
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sparse-query")
+        
+        # Initialize Reranker (opt-in via ENABLE_RERANKER)
+        self.reranker = None
+        if ENABLE_RERANKER:
+            print(f"Loading Reranker Model ({RERANKER_BACKEND} backend)...")
+            # Non-torch backends need sentence-transformers >= 4.1 (and
+            # onnxruntime-gpu for ONNX on CUDA); the model is exported on first load
+            backend_kwargs = {} if RERANKER_BACKEND == "torch" else {'backend': RERANKER_BACKEND}
+            self.reranker = CrossEncoder(
+                model_name=RERANKER_MODEL_NAME,
+                device=device,
+                trust_remote_code=True,
+                **backend_kwargs
+            )
+            fp16 = device == "cuda" and RERANKER_BACKEND == "torch"
+            if fp16:
+                self.reranker.model.half()
+
+            # Persistent (model, query, passage hash) -> score cache. Passages are
+            # keyed by a SHA-1 of their text rather than the point id: ingestion
+            # assigns fresh uuid4 ids, so id-keyed rows would go stale on every
+            # re-ingest while identical text still scores the same. The query
+            # text is stored as-is because Python's hash() is salted per process.
+            # Backend and precision are part of the model key: ONNX and FP16 runs
+            # score slightly differently from an FP32 torch run of the same weights.
+            self._score_cache_model = f"{RERANKER_MODEL_NAME}|{RERANKER_BACKEND}|{'fp16' if fp16 else 'fp32'}"
+            self._score_cache = sqlite3.connect(RERANK_CACHE_PATH, check_same_thread=False)
+            self._score_cache.execute(
+                "CREATE TABLE IF NOT EXISTS rerank_pair_scores ("
+                "model TEXT, query TEXT, passage_hash TEXT, score REAL, "
+                "PRIMARY KEY (model, query, passage_hash))"
+            )
+            self._score_cache_lock = threading.Lock()
+
+    def _embed_query(self, text: str) -> tuple:
+        """
+        Dense query embedding, returned as a tuple so cached values stay immutable.
+        """
+        return tuple(self.embeddings.embed_query(text))
 
     def build_sparse_query(self, text: str) -> SparseVector:
         """
         Build a simple sparse vector from query text.
-        Uses hash-based indexing for query-time efficiency.
+        Uses the same hashed indices as ingestion (see sparse_vectors.py).
         """
-        tokens = text.lower().split()
-        token_counts = {}
-        
-        # Count token frequencies
-        for token in tokens:
-            token_counts[token] = token_counts.get(token, 0) + 1
-        
-        # Build sparse vector using hash-based indices
-        indices = []
-        values = []
-        
-        for token, count in token_counts.items():
-            # Use hash for index (modulo to keep reasonable range)
-            idx = abs(hash(token)) % 100000
-            indices.append(idx)
-            values.append(float(count))
-        
-        return SparseVector(
-            indices=indices,
-            values=values
-        )
+        return build_sparse_vector(text)
 
 
     def check_connection(self) -> bool:
@@ -89,17 +134,19 @@ class PhysicsRetriever:
         except Exception:
             return {'vectors_count': 0, 'status': 'unknown'}
 
+    def refresh_collection_stats(self) -> Dict[str, Any]:
+        """
+        Re-reads collection metadata after an ingestion.
+        Models stay loaded; only the Qdrant collection info is refreshed.
+        """
+        self.collection_stats = self.get_collection_stats()
+        return self.collection_stats
+
     def retrieve(self, query: str, top_k: int = 20, chapter_filter: str = None) -> List[Any]:
         """
         Hybrid retrieval using query_points API with RRF fusion
         Combines dense semantic search + sparse BM25 keyword search
         """
-        # Generate dense embedding
-        query_vector = self.embeddings.embed_query(query)
-        
-        # Generate sparse vector
-        sparse_query = self.build_sparse_query(query)
-
         # Build filter
         query_filter = None
         if chapter_filter and chapter_filter != ["All Chapters"]:
@@ -125,6 +172,11 @@ class PhysicsRetriever:
                         )
                     ]
                 )
+
+        # Dense + sparse query vectors (cached per query text), built concurrently
+        sparse_future = self._executor.submit(self._sparse_query, query)
+        query_vector = list(self._encode_query(query))
+        sparse_query = sparse_future.result()
         
         # Hybrid search with RRF fusion
         response = self.client.query_points(
@@ -147,6 +199,8 @@ class PhysicsRetriever:
             limit=top_k,
             query_filter=query_filter,
             with_payload=True,
+            # Dense vectors are only used to collapse near-duplicates before reranking
+            with_vectors=["dense"] if self.reranker is not None else False,
             score_threshold=0.3
         )
         
@@ -155,15 +209,162 @@ class PhysicsRetriever:
 
     def rerank(self, query: str, initial_results: List[Any], top_k: int = 6) -> List[Any]:
         """
-        Stage 2: Cross-Encoder Reranking (DISABLED)
+        Stage 2: Cross-Encoder Reranking
+        Candidate pairs are scored in length-bucketed batches.
+        Falls back to the retrieval order when the reranker is disabled.
+        """
+        if not initial_results:
+            return []
+
+        if self.reranker is None:
+            return initial_results[:top_k]
+
+        # Positional views shared by every stage; points are only mapped back at the end
+        scores = np.fromiter((r.score for r in initial_results), dtype=np.float32, count=len(initial_results))
+        texts = [r.payload['text'] for r in initial_results]
+
+        keep = self._dedupe_candidates(initial_results, scores)
+        keep = self._prune_candidates(query, keep, texts, scores, max(top_k, RERANK_CANDIDATES))
+        rerank_scores = self._cached_scores(query, [texts[i] for i in keep])
+
+        # Partial sort: select the top_k scores, then order only those
+        k = min(top_k, len(rerank_scores))
+        top = np.argpartition(-rerank_scores, k - 1)[:k]
+        top = top[np.argsort(-rerank_scores[top], kind="stable")]
+
+        reranked = []
+        for t in top:
+            result = initial_results[keep[t]]
+            result.payload['rerank_score'] = float(rerank_scores[t])
+            reranked.append(result)
+        return reranked
+
+    def _predict_scores(self, query: str, texts: List[str]) -> np.ndarray:
+        """
+        Cross-encoder scores for (query, text) pairs.
+        Pairs are grouped into token-length buckets and each bucket is
+        scored in its own batch, which keeps padding to a minimum.
+        """
+        pairs = [(query, text) for text in texts]
+        lengths = self.reranker.tokenizer(
+            [query] * len(texts), texts, truncation=True, return_length=True
+        )["length"]
+
+        buckets = {}
+        for i, length in enumerate(lengths):
+            buckets.setdefault(bisect.bisect_left(RERANK_LENGTH_BUCKETS, length), []).append(i)
+
+        scores = np.empty(len(pairs), dtype=np.float32)
+        for indices in buckets.values():
+            scores[indices] = self.reranker.predict(
+                [pairs[i] for i in indices], batch_size=32, convert_to_numpy=True
+            )
+        return scores
+
+    def _dedupe_candidates(self, results: List[Any], scores: np.ndarray) -> np.ndarray:
+        """
+        Collapses near-duplicate chunks with a union-find over dense-vector
+        cosine similarity. Returns the indices of the best-scored member
+        of each cluster, in retrieval order.
+        """
+        all_indices = np.arange(len(results))
+        vectors = [r.vector.get("dense") if isinstance(r.vector, dict) else None for r in results]
+        if len(results) < 2 or any(v is None for v in vectors):
+            return all_indices
+
+        V = np.asarray(vectors, dtype=np.float32)
+        V /= np.linalg.norm(V, axis=1, keepdims=True) + 1e-12
+        duplicate_pairs = np.argwhere(np.triu(V @ V.T > DEDUP_SIMILARITY, k=1))
+        if len(duplicate_pairs) == 0:
+            return all_indices
+
+        parent = list(range(len(results)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for i, j in duplicate_pairs:
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+        best = {}
+        for i in all_indices:
+            root = find(i)
+            if root not in best or scores[i] > scores[best[root]]:
+                best[root] = i
+        return np.sort(np.fromiter(best.values(), dtype=np.intp, count=len(best)))
+
+    def _prune_candidates(self, query: str, keep: np.ndarray, texts: List[str], scores: np.ndarray, limit: int) -> np.ndarray:
+        """
+        Stage 1: cheap prune before the cross-encoder.
+        Blends query-token overlap with the normalised retrieval score and
+        returns the best `limit` indices from `keep`, in retrieval order.
+        """
+        if len(keep) <= limit:
+            return keep
+
+        q_tokens = set(query.lower().split())
+        q_len = max(len(q_tokens), 1)
+        overlap = np.fromiter(
+            (len(q_tokens.intersection(texts[i].lower().split())) / q_len for i in keep),
+            dtype=np.float32,
+            count=len(keep)
+        )
+        kept_scores = scores[keep]
+        max_score = kept_scores.max() or 1.0
+
+        blended = 0.5 * overlap + 0.5 * kept_scores / max_score
+        return np.sort(keep[np.argsort(-blended, kind="stable")[:limit]])
+
+    def _cached_scores(self, query: str, texts: List[str]) -> np.ndarray:
+        """
+        Reranker scores backed by the SQLite score cache.
+        Only pairs not scored before are sent through the cross-encoder.
+        """
+        keys = [hashlib.sha1(t.encode("utf-8")).hexdigest() for t in texts]
+        placeholders = ",".join("?" * len(keys))
+        with self._score_cache_lock:
+            rows = self._score_cache.execute(
+                "SELECT passage_hash, score FROM rerank_pair_scores "
+                f"WHERE model = ? AND query = ? AND passage_hash IN ({placeholders})",
+                (self._score_cache_model, query, *keys)
+            ).fetchall()
+        hits = dict(rows)
+
+        scores = np.empty(len(keys), dtype=np.float32)
+        misses = []
+        for i, key in enumerate(keys):
+            if key in hits:
+                scores[i] = hits[key]
+            else:
+                misses.append(i)
+
+        if misses:
+            miss_scores = self._predict_scores(query, [texts[i] for i in misses])
+            scores[misses] = miss_scores
+            with self._score_cache_lock:
+                self._score_cache.executemany(
+                    "INSERT OR REPLACE INTO rerank_pair_scores VALUES (?, ?, ?, ?)",
+                    [(self._score_cache_model, query, keys[i], float(score)) for i, score in zip(misses, miss_scores)]
+                )
+                self._score_cache.commit()
+
+        return scores
+
+    def retrieve_and_rerank(self, query: str, top_k: int = 20, final_k: int = 6, chapter_filter: str = None) -> List[Any]:
+        """
+        Fused retrieval + reranking: the query is encoded once for the
+        hybrid search and the candidates are reranked in one batch.
         """
-        # Simply return top K from initial results to save time
-        return initial_results[:top_k]
+        initial_results = self.retrieve(query, top_k=top_k, chapter_filter=chapter_filter)
+        return self.rerank(query, initial_results, top_k=final_k)
         
     def search(self, query: str, chapter_filter: str = None) -> List[Any]:
-        initial_results = self.retrieve(query, chapter_filter=chapter_filter)
-        final_results = self.rerank(query, initial_results)
-        return final_results
+        return self.retrieve_and_rerank(query, chapter_filter=chapter_filter)
 
 
     
@@ -171,6 +372,9 @@ class PhysicsRetriever:
         """
         Explicitly closes the Qdrant client connection.
         """
+        self._executor.shutdown(wait=False)
+        if self.reranker is not None:
+            self._score_cache.close()
         if self.client:
             print("Closing Qdrant client...")
             self.client.close()
@@ -0,0 +1,26 @@
+import zlib
+from collections import Counter
+from qdrant_client.models import SparseVector
+
+# Size of the hashed index space shared by ingestion and retrieval
+SPARSE_DIM = 100000
+
+def token_index(token: str) -> int:
+    """
+    Stable sparse index for a token.
+    crc32 is deterministic across processes (unlike the salted builtin hash),
+    so documents and queries always map a token to the same index.
+    """
+    return zlib.crc32(token.encode("utf-8", "ignore")) % SPARSE_DIM
+
+def build_sparse_vector(text: str) -> SparseVector:
+    """
+    Term-frequency sparse vector over hashed token indices.
+    Counting by index also merges colliding tokens, so indices stay unique.
+    """
+    index_counts = Counter(map(token_index, text.lower().split()))
+
+    return SparseVector(
+        indices=list(index_counts.keys()),
+        values=[float(count) for count in index_counts.values()]
+    )
@@ -2,114 +2,259 @@ import fitz
 import re
 import config
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-def get_diagram_bbox(page, caption_block, split_x):
-    """Finds diagrams strictly within the same column as the caption."""
-    caption_rect = fitz.Rect(caption_block[:4])
-    is_left_col = caption_rect.x0 < split_x
+# Compiled once at import; both run against every block on every page
+FIGURE_RE = re.compile(config.RULES["FIGURE_PATTERN"], re.I)
+HEADING_RE = re.compile(config.RULES["HEADING_PATTERN"])
+
+# Short documents aren't worth the worker start-up cost
+MIN_PAGES_FOR_POOL = 4
+MAX_PAGE_WORKERS = 8
+
+# MuPDF keeps fonts/images of visited pages in a global store; emptying it
+# every few pages keeps memory flat on long books
+STORE_FLUSH_INTERVAL = 20
+
+# Diagrams are rendered at 3x for legibility
+_ZOOM3 = fitz.Matrix(3, 3)
+
+# PNG writes go through a small thread pool so disk I/O overlaps the next
+# page's parse. Encoding stays on the page's thread: Pixmaps aren't thread-safe.
+_io_pool = ThreadPoolExecutor(max_workers=4)
+
+def _write_png(data, path):
+    with open(path, "wb") as f:
+        f.write(data)
+
+def _queue_png_writes(pngs, pending):
+    """
+    Queues one page's (path, png_bytes) writes. Pages are fed in page order,
+    and a path still being written by an earlier page is waited on first,
+    so the later page wins exactly as in a plain sequential run.
+    """
+    for path, data in pngs:
+        prev = pending.get(path)
+        if prev is not None:
+            prev.result()
+        pending[path] = _io_pool.submit(_write_png, data, path)
+
+def _blk_text(b):
+    """Joins the spans of a get_text("dict") block into one stripped string."""
+    return " ".join(s["text"] for l in b["lines"] for s in l["spans"]).strip()
+
+def _caption_text(b):
+    """Block text as get_text("blocks") would give it, on one line.
+
+    Spans are joined without separators and lines with newlines, matching
+    the blocks extraction that captions were originally read from.
+    """
+    return "\n".join("".join(s["text"] for s in l["spans"]) for l in b["lines"]).strip().replace("\n", " ")
+
+def _top(entry):
+    return entry["bbox"][1]
+
+def get_diagram_bbox(caption_bbox, split_x, page_width, page_drawings):
+    """Finds diagrams strictly within the same column as the caption.
+
+    page_drawings is the page's drawing rects as (x0, y0, x1, y1) float
+    tuples, collected once by the caller so pages with several captions
+    don't re-run get_drawings().
+    """
+    cap_x0, cap_y0 = caption_bbox[0], caption_bbox[1]
+    is_left_col = cap_x0 < split_x
     
     # Define Column Boundaries to prevent bleed-over
     col_min_x = 0 if is_left_col else split_x
-    col_max_x = split_x if is_left_col else page.rect.width
+    col_max_x = split_x if is_left_col else page_width
     
     # Define Vertical Search Area (Above the caption)
-    search_area = fitz.Rect(col_min_x, caption_rect.y0 - 300, col_max_x, caption_rect.y0)
+    top, bottom = cap_y0 - 300, cap_y0
     
-    # Filter drawings that stay WITHIN this specific column
+    # Filter drawings that stay WITHIN this specific column. The overlap test
+    # mirrors Rect.intersects (empty rects never match) on plain floats.
     drawings = [
-        d["rect"] for d in page.get_drawings() 
-        if d["rect"].intersects(search_area) and d["rect"].x0 >= col_min_x and d["rect"].x1 <= col_max_x
+        r for r in page_drawings
+        if r[0] < r[2] and r[1] < r[3]
+        and r[1] < bottom and top < r[3]
+        and r[0] >= col_min_x and r[2] <= col_max_x
     ]
     
     if not drawings:
         return None
         
-    diagram_box = drawings[0]
-    for d_rect in drawings[1:]:
-        diagram_box |= d_rect
-        
+    diagram_box = fitz.Rect(
+        min(r[0] for r in drawings), min(r[1] for r in drawings),
+        max(r[2] for r in drawings), max(r[3] for r in drawings),
+    )
     return diagram_box + (-5, -5, 5, 5)
 
-def classify_and_clean(pdf_path=None, image_output_dir=None):
+def _process_page(page, target_image_dir):
+    """
+    Classifies one page and encodes its diagrams.
+    Returns (items, pngs); pngs is a list of (path, png_bytes) for the caller
+    to write, so writes land in page order even when pages run in workers.
+    """
+    items = []
+    page_width = page.rect.width
+    split_x = page_width * config.COLUMN_GAP_THRESHOLD
+    # One text parse per page; captions and body text both read from it
+    raw_blocks = page.get_text("dict")["blocks"]
+    diagrams_on_page = []
+    page_drawings = None  # fetched on the first caption hit only
+    
+    # 1. FIND CAPTION ANCHORS (Updated Naming Logic)
+    for b in raw_blocks:
+        if "lines" not in b:
+            continue
+        text = _caption_text(b)
+        # Uses the regex group from config to find the specific ID (e.g., 6.1)
+        match = FIGURE_RE.search(text)
+        
+        if match:
+            if page_drawings is None:
+                page_drawings = [tuple(d["rect"]) for d in page.get_drawings()]
+            area = get_diagram_bbox(b["bbox"], split_x, page_width, page_drawings)
+            if area:
+                # Extracts the ID (e.g., '6.1') and formats it as 'fig_6_1.png'
+                fig_id = match.group(1).replace('.', '_')
+                img_filename = f"fig_{fig_id}.png"
+                img_path = os.path.join(target_image_dir, img_filename)
+                
+                diagrams_on_page.append({
+                    "bbox": area,
+                    "path": img_path,
+                    "caption": text,
+                    "is_left": area.x0 < split_x
+                })
+
+    # Rasterize the diagrams. With several on one page, rendering the page
+    # once and cropping is cheaper than a clipped render per diagram.
+    # Pixmaps are RGB without alpha and dropped as soon as they're encoded;
+    # a full 3x page is tens of MB and shouldn't outlive the crops.
+    # Several captions can resolve to the same fig_*.png; only the last one
+    # on the page survives, so render and encode each path once.
+    targets = list({d["path"]: d for d in diagrams_on_page}.values())
+    pngs = []
+    if len(targets) > 1:
+        full_pix = page.get_pixmap(matrix=_ZOOM3, alpha=False)
+        for d in targets:
+            irect = (d["bbox"] * _ZOOM3).irect & full_pix.irect
+            pix = fitz.Pixmap(full_pix.colorspace, irect, False)
+            pix.copy(full_pix, irect)
+            pngs.append((d["path"], pix.tobytes("png")))
+            pix = None
+        full_pix = None
+    else:
+        for d in targets:
+            pix = page.get_pixmap(clip=d["bbox"], matrix=_ZOOM3, alpha=False)
+            pngs.append((d["path"], pix.tobytes("png")))
+            pix = None
+
+    # 2. PROCESS TEXT & MERGE FLOW
+    left_col, right_col = [], []
+    processed_captions = {d["caption"] for d in diagrams_on_page}
+
+    for b in raw_blocks:
+        if "lines" in b:
+            text = _blk_text(b)
+            if text in processed_captions or not text or "Reprint" in text:
+                continue
+            
+            # Keep the joined text so the final pass doesn't rebuild it
+            entry = {"bbox": b["bbox"], "text": text}
+            if b["bbox"][0] < split_x: left_col.append(entry)
+            else: right_col.append(entry)
+
+    # Insert Diagram Markers into respective columns
+    for d in diagrams_on_page:
+        # We want the path in the JSON to be relative or absolute?
+        # The ingestion script expects just the filename in the tag usually, or we can keep full path.
+        # Ingest logic: cleans path separators, grabs filename. 
+        # So full path here is fine, ingest will handle it.
+        # But let's standardize separators to be safe.
+        normalized_path = d["path"].replace("\\", "/")
+        marker = {"type": "DIAGRAM", "bbox": d["bbox"], "value": f"[IMAGE: {normalized_path}]", "caption": d["caption"]}
+        if d["is_left"]: left_col.append(marker)
+        else: right_col.append(marker)
+
+    # 3. FINAL EXTRACTION
+    # Every column entry is a dict with a bbox, so one plain key serves both
+    left_col.sort(key=_top)
+    right_col.sort(key=_top)
+    
+    for item in (left_col + right_col):
+        if "text" in item:
+            text = item["text"]
+            itype = "HEADING" if HEADING_RE.match(text) else "CONTENT"
+            items.append({"type": itype, "value": text})
+        elif item.get("type") == "DIAGRAM":
+            items.append({"type": "CONTENT", "value": item["value"]})
+            items.append({"type": "CONTENT", "value": item["caption"]})
+
+    return items, pngs
+
+# Per-worker state for the process pool: each worker opens its own
+# document, since MuPDF objects can't be shared across processes.
+_worker_doc = None
+_worker_image_dir = None
+_worker_pages_done = 0
+
+def _init_worker(pdf_path, image_dir):
+    global _worker_doc, _worker_image_dir
+    _worker_doc = fitz.open(pdf_path)
+    _worker_image_dir = image_dir
+
+def _process_page_in_worker(page_num):
+    global _worker_pages_done
+    result = _process_page(_worker_doc.load_page(page_num), _worker_image_dir)
+    _worker_pages_done += 1
+    if _worker_pages_done % STORE_FLUSH_INTERVAL == 0:
+        fitz.TOOLS.store_shrink(100)
+    return result
+
+def classify_and_clean(pdf_path=None, image_output_dir=None, workers=1):
+    """
+    workers > 1 classifies pages in a spawn-based process pool. Only pass it
+    from __main__-guarded scripts: spawn re-imports the caller's __main__ in
+    every worker, which under Streamlit means re-running the whole app.
+    """
     # Default to config if not provided
     target_pdf = pdf_path if pdf_path else config.PDF_PATH
     target_image_dir = image_output_dir if image_output_dir else config.IMAGE_DIR
 
     doc = fitz.open(target_pdf)
     all_items = []
+    pending_writes = {}  # path -> latest write future
+    workers = min(workers, MAX_PAGE_WORKERS)
     
-    if not os.path.exists(target_image_dir):
-        os.makedirs(target_image_dir)
+    os.makedirs(target_image_dir, exist_ok=True)
 
-    for page_num, page in enumerate(doc):
-        split_x = page.rect.width * config.COLUMN_GAP_THRESHOLD
-        blocks = page.get_text("blocks")
-        diagrams_on_page = []
-        
-        # 1. FIND CAPTION ANCHORS (Updated Naming Logic)
-        for b in blocks:
-            text = b[4].strip().replace("\n", " ")
-            # Uses the regex group from config to find the specific ID (e.g., 6.1)
-            match = re.search(config.RULES["FIGURE_PATTERN"], text, re.I)
-            
-            if match:
-                area = get_diagram_bbox(page, b, split_x)
-                if area:
-                    # Extracts the ID (e.g., '6.1') and formats it as 'fig_6_1.png'
-                    fig_id = match.group(1).replace('.', '_')
-                    img_filename = f"fig_{fig_id}.png"
-                    img_path = os.path.join(target_image_dir, img_filename)
-                    
-                    pix = page.get_pixmap(clip=area, matrix=fitz.Matrix(3, 3))
-                    pix.save(img_path)
-                    
-                    diagrams_on_page.append({
-                        "bbox": area,
-                        "path": img_path,
-                        "caption": text,
-                        "is_left": area.x0 < split_x
-                    })
-
-        # 2. PROCESS TEXT & MERGE FLOW
-        page_dict = page.get_text("dict")
-        raw_blocks = page_dict["blocks"]
-        
-        left_col, right_col = [], []
-        processed_captions = [d["caption"] for d in diagrams_on_page]
-
-        for b in raw_blocks:
-            if "lines" in b:
-                text = " ".join([s["text"] for l in b["lines"] for s in l["spans"]]).strip()
-                if text in processed_captions or not text or "Reprint" in text:
-                    continue
-                
-                if b["bbox"][0] < split_x: left_col.append(b)
-                else: right_col.append(b)
-
-        # Insert Diagram Markers into respective columns
-        for d in diagrams_on_page:
-            # We want the path in the JSON to be relative or absolute?
-            # The ingestion script expects just the filename in the tag usually, or we can keep full path.
-            # Ingest logic: cleans path separators, grabs filename. 
-            # So full path here is fine, ingest will handle it.
-            # But let's standardize separators to be safe.
-            normalized_path = d["path"].replace("\\", "/")
-            marker = {"type": "DIAGRAM", "bbox": d["bbox"], "value": f"[IMAGE: {normalized_path}]", "caption": d["caption"]}
-            if d["is_left"]: left_col.append(marker)
-            else: right_col.append(marker)
-
-        # 3. FINAL EXTRACTION
-        left_col.sort(key=lambda x: x["bbox"][1] if "bbox" in x else x[1])
-        right_col.sort(key=lambda x: x[1] if isinstance(x, list) else x["bbox"][1])
-        
-        for item in (left_col + right_col):
-            if isinstance(item, dict) and "lines" in item:
-                text = " ".join([s["text"] for l in item["lines"] for s in l["spans"]]).strip()
-                itype = "HEADING" if re.match(config.RULES["HEADING_PATTERN"], text) else "CONTENT"
-                all_items.append({"type": itype, "value": text})
-            elif isinstance(item, dict) and item.get("type") == "DIAGRAM":
-                all_items.append({"type": "CONTENT", "value": item["value"]})
-                all_items.append({"type": "CONTENT", "value": item["caption"]})
+    if len(doc) < MIN_PAGES_FOR_POOL or workers < 2:
+        for page_num in range(doc.page_count):
+            page_items, pngs = _process_page(doc.load_page(page_num), target_image_dir)
+            all_items.extend(page_items)
+            _queue_png_writes(pngs, pending_writes)
+            if (page_num + 1) % STORE_FLUSH_INTERVAL == 0:
+                fitz.TOOLS.store_shrink(100)
+    else:
+        # Pages are independent, so fan them out; map() keeps page order,
+        # and images come back as bytes so the parent writes them in order.
+        # spawn rather than fork: MuPDF state isn't fork-safe.
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(target_pdf, target_image_dir),
+        ) as pool:
+            for page_items, pngs in pool.map(_process_page_in_worker, range(len(doc)), chunksize=4):
+                all_items.extend(page_items)
+                _queue_png_writes(pngs, pending_writes)
+
+    # Images must be on disk before the [IMAGE: ...] tags are handed on
+    for fut in pending_writes.values():
+        fut.result()
 
     # Summary Log
     print(f"[DEBUG] classify_and_clean: Processed {len(doc)} pages.")
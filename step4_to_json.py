@@ -1,10 +1,16 @@
 import json
+import os
 import config
 from step3_classify_blocks import classify_and_clean
 
-def build_hierarchy(classified_items):
+try:
+    import orjson  # optional; encodes in C, roughly 5-10x faster than json.dump
+except ImportError:
+    orjson = None
+
+def build_hierarchy(classified_items, chapter_title=config.CHAPTER_TITLE):
     root = {
-        "chapter_title": "SYSTEMS OF PARTICLES AND ROTATIONAL MOTION", 
+        "chapter_title": chapter_title, 
         "sections": [], 
         "exercises": []
     }
@@ -14,15 +20,19 @@ def build_hierarchy(classified_items):
     for item in classified_items:
         itype, ivalue = item["type"], item["value"]
 
-        # 1. Exercises handling
-        if itype == "EXERCISE" or in_exercises:
+        # 1. Exercises handling (once inside, skip the upper() scan)
+        if in_exercises:
+            root["exercises"].append(ivalue)
+            continue
+        if itype == "EXERCISE":
             if "EXERCISES" in ivalue.upper(): in_exercises = True
             root["exercises"].append(ivalue)
             continue
 
         # 2. Section/Subsection logic
         if itype == "HEADING":
-            id_tag = ivalue.split()[0]
+            # Only the leading id is needed; maxsplit=1 avoids splitting the whole title
+            id_tag = ivalue.split(None, 1)[0]
             level = id_tag.count('.')
             
             if level == 1: # e.g., 6.1
@@ -51,12 +61,18 @@ def build_hierarchy(classified_items):
     return root
 
 def save_structure(structure, output_path):
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(structure, f, indent=4, ensure_ascii=False)
+    # Both paths write the same 2-space, UTF-8 JSON
+    if orjson is not None:
+        with open(output_path, "wb") as f:
+            f.write(orjson.dumps(structure, option=orjson.OPT_INDENT_2))
+    else:
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(structure, f, indent=2, ensure_ascii=False)
     print(f"Saved structure to: {output_path}")
 
 if __name__ == "__main__":
-    raw_data = classify_and_clean() # uses config defaults
+    # uses config defaults; safe to fan out pages here behind the __main__ guard
+    raw_data = classify_and_clean(workers=os.cpu_count() or 1)
     structured_json = build_hierarchy(raw_data)
     save_structure(structured_json, config.OUTPUT_JSON)
     print(f"Success! Reverted to older string-list pattern in: {config.OUTPUT_JSON}")
\ No newline at end of file
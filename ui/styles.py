@@ -1,7 +1,7 @@
 import streamlit as st
 
-def load_custom_css():
-    st.markdown("""
+# Built once at import; reruns just re-send the same string
+_CSS = """
     <style>
     /* Chat message styling */
     /* Chat message styling */
@@ -57,4 +57,8 @@ def load_custom_css():
         padding: 1rem;
     }
     </style>
-    """, unsafe_allow_html=True)
+    """
+
+def load_custom_css():
+    # Must run on every rerun: Streamlit drops elements a run doesn't emit
+    st.markdown(_CSS, unsafe_allow_html=True)